@@ -1,9 +1,25 @@
 import asyncio
+from collections import deque
 import os
-from typing import Dict, Optional, Set
+from typing import Dict, Optional
 import uuid
+import weakref
 import asyncssh
 
+# Static replies, encoded once at import time and reused across all sessions.
+WELCOME = b'Welcome to the chat server!\r\n'
+AUTH_REQUIRED = b'Please authenticate first. \r\n'
+JOIN_USAGE = b'Usage: /join <room_name>\r\n'
+NO_ROOM = b'You must join a room first.\r\n'
+LEFT_ROOM = b'Left the room.\r\n'
+NO_ROOMS = b'There are no rooms available. \r\n'
+
+# Command names, kept as bytes so dispatch can compare raw input without decoding.
+CMD_JOIN = b"/join"
+CMD_LIST = b"/list"
+CMD_LEAVE = b"/leave"
+CMD_USERS = b"/users"
+
 class UserManager:
     """
     Manages user-related data and operations.
@@ -46,11 +62,12 @@ class RoomManager:
     def __init__(self):
         """Initializes the RoomManager."""
         self.chat_rooms: Dict[str, ChatRoom] = {}  # room_name: ChatRoom
+        self._rooms_cache: Optional[str] = None  # Cached ", "-joined room names
 
     def get_room(self, room_name: str) -> "ChatRoom":
         """
         Retrieves a chat room by name, creating it if it doesn't exist.
-        
+
         Args:
             room_name (str): The name of the chat room.
 
@@ -59,12 +76,26 @@ class RoomManager:
         """
         if room_name not in self.chat_rooms:
             self.chat_rooms[room_name] = ChatRoom(room_name)
+            self._rooms_cache = None
         return self.chat_rooms[room_name]
-    
+
+    def remove_room(self, room_name: str):
+        """Removes a chat room by name, stopping its drain task."""
+        room = self.chat_rooms.pop(room_name, None)
+        if room is not None:
+            room.close()
+            self._rooms_cache = None
+
     def get_rooms(self) -> list:
         """Returns the list of available rooms"""
         return self.chat_rooms.values()
 
+    def get_rooms_str(self) -> str:
+        """Returns the room names joined by ", ", recomputing only after a room is added or removed."""
+        if self._rooms_cache is None:
+            self._rooms_cache = ", ".join(r.name for r in self.chat_rooms.values())
+        return self._rooms_cache
+
 
 class User:
     """
@@ -84,10 +115,21 @@ class User:
             username (str): The username of the user.
             channel: The SSH channel for communication with the user.
         """
-        self.id = str(uuid.uuid4())
+        self._id: Optional[str] = None
         self.username = username
         self.channel = channel
         self.room = None
+        self._prefix = f"{username}: ".encode()  # Cached broadcast prefix
+        self._join_notice = f"{username} joined the room.\r\n".encode()
+        self._leave_notice = f"{username} left the room.\r\n".encode()
+        self._channels = []  # Live session channels; multiplexed clients may hold several
+
+    @property
+    def id(self) -> str:
+        """The unique identifier, generated on first access to keep connects cheap."""
+        if self._id is None:
+            self._id = str(uuid.uuid4())
+        return self._id
 
 class ChatRoom:
     """
@@ -96,8 +138,8 @@ class ChatRoom:
     Attributes:
         id (str): A unique identifier for the chat room.
         name (str): The name of the chat room.
-        users (Set[User]): The set of users currently in the chat room.
-        messages (list): A list of messages sent in the chat room.
+        users (Dict[str, User]): The users currently in the chat room, keyed by username.
+        messages (deque): The most recent (username, message) pairs sent in the chat room.
     """
     def __init__(self, name: str):
         """
@@ -106,28 +148,83 @@ class ChatRoom:
         Args:
             name (str): The name of the chat room.
         """
-        self.id = str(uuid.uuid4())
+        self._id: Optional[str] = None
         self.name = name
-        self.users: Set[User] = set()
-        self.messages = []  # Store messages (optional, for message history)
+        # Weak values so a user whose session vanished without a clean /leave
+        # is dropped from the room once the last strong reference goes away.
+        self.users = weakref.WeakValueDictionary()  # username: User
+        self.messages = deque(maxlen=1024)  # Recent message history, oldest evicted first
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._drain_task = asyncio.create_task(self._drain())
+
+    @property
+    def id(self) -> str:
+        """The unique identifier, generated on first access to keep room creation cheap."""
+        if self._id is None:
+            self._id = str(uuid.uuid4())
+        return self._id
 
     def add_user(self, user: User):
         """Adds a user to the chat room."""
-        self.users.add(user)
+        self.users[user.username] = user
 
     def remove_user(self, user: User):
         """Removes a user from the chat room."""
-        self.users.discard(user)
+        self.users.pop(user.username, None)
 
     def broadcast_message(self, message: str, sender: User):
-        """Broadcasts a message to all users in the chat room except the sender."""
-        for user in self.users:
-            if user != sender:
-                user.channel.write(f"{sender.username}: {message}\r\n")
+        """Queues a message for broadcast to all users in the chat room except the sender."""
+        self._queue.put_nowait((sender, sender._prefix + message.encode() + b"\r\n"))
+
+    def broadcast_bytes(self, payload: bytes, sender: User):
+        """Queues an already-encoded payload for broadcast, skipping the format step."""
+        self._queue.put_nowait((sender, payload))
+
+    async def _drain(self):
+        """Drains queued messages, batching bursts into one write per recipient."""
+        while True:
+            item = await self._queue.get()
+            # Wait briefly so messages arriving in a burst are coalesced
+            # into a single write per recipient instead of one write each.
+            await asyncio.sleep(0.001)
+            batch = [item]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # Lines are already encoded when queued; hand the same byte
+            # fragments to every channel's writelines and let the transport
+            # concatenate, instead of joining a fresh buffer per recipient.
+            try:
+                for user in tuple(self.users.values()):
+                    frags = [line for sender, line in batch if sender is not user]
+                    if not frags:
+                        continue
+                    try:
+                        user.channel.writelines(frags)
+                    except (OSError, asyncssh.misc.ChannelOpenError):
+                        # The channel closed under us; connection_lost will
+                        # detach the user, so just skip them for this batch.
+                        continue
+                    except Exception as e:
+                        # Log unexpected per-channel failures but keep the
+                        # batch flowing to the remaining recipients.
+                        print(f"Error broadcasting to {user.username} in room {self.name}:", e)
+            except Exception as e:
+                # An unforeseen error must not kill the drain task — that
+                # would silence the room permanently. Log it and keep going.
+                print(f"Error broadcasting in room {self.name}:", e)
+
+    def close(self):
+        """Stops the room's drain task so the room can be garbage collected."""
+        self._drain_task.cancel()
 
     def send_message(self, message:str, sender:User):
-        """Sends a message and store it in the list of messages"""
-        self.messages.append({"sender": sender.username, "message": message})
+        """Sends a message and store it in the message history"""
+        self.messages.append((sender.username, message))
+
+    def post(self, message: str, sender: User):
+        """Records a message in the history and queues it for broadcast in one pass."""
+        self.messages.append((sender.username, message))
+        self.broadcast_message(message, sender)
 
 class CommandHandler:
     """
@@ -140,66 +237,69 @@ class CommandHandler:
         self.user_manager = user_manager
         self.room_manager = room_manager
         self.session = session
-        
-    def handle_command(self, decoded_data: str):
-        """Handles the command sent by the user."""
-        if decoded_data.startswith("/join"):
-            parts = decoded_data.split(" ")
-            if len(parts) < 2:
-                self.session.chan.write("Usage: /join <room_name>\r\n")
-                return
-            room_name = parts[1]
-            self.join_room(room_name)
-        elif decoded_data == "/list":
-            self.list_rooms()
-        elif decoded_data.startswith("/leave"):
-            self.leave_room()
-        elif decoded_data.startswith("/users"):
-            self.list_users()
+        self._table = {
+            CMD_JOIN: self.join_room,
+            CMD_LIST: self.list_rooms,
+            CMD_LEAVE: self.leave_room,
+            CMD_USERS: self.list_users,
+        }  # command: handler
+
+    def handle_command(self, line: bytes):
+        """Handles the command sent by the user, dispatching on the raw bytes."""
+        cmd, _, rest = line.partition(b" ")
+        handler = self._table.get(cmd)
+        if handler is None:
+            self.send_message(line.decode("utf-8", errors="replace"))
         else:
-            self.send_message(decoded_data)
+            handler(rest)
 
-    def join_room(self, room_name: str):
+    def join_room(self, rest: bytes = b""):
         """Handles the /join command."""
+        room_name_raw, _, _ = rest.partition(b" ")
+        if not room_name_raw:
+            self.session._write(JOIN_USAGE)
+            return
+        room_name = room_name_raw.decode("utf-8", errors="replace")
         room = self.room_manager.get_room(room_name)
         if self.session.user.room:
             self.leave_room() #If already in a room, leave it
         room.add_user(self.session.user)
         self.session.user.room = room
         room.send_message(f"{self.session.user.username} joined the room.",self.session.user)
-        self.session.chan.write(f"Joined room {room_name}\r\n")
+        room.broadcast_bytes(self.session.user._join_notice,self.session.user)
+        self.session._write(f"Joined room {room_name}\r\n".encode())
     
-    def leave_room(self):
+    def leave_room(self, rest: bytes = b""):
         """Handles the /leave command."""
         if self.session.user.room:
             self.session.user.room.remove_user(self.session.user)
             self.session.user.room.send_message(f"{self.session.user.username} left the room.",self.session.user)
+            self.session.user.room.broadcast_bytes(self.session.user._leave_notice,self.session.user)
             self.session.user.room = None
-            self.session.chan.write(f"Left the room.\r\n")
+            self.session._write(LEFT_ROOM)
 
     def send_message(self, message):
         """Sends a message in the current room."""
         if not self.session.user.room:
-            self.session.chan.write(f"You must join a room first.\r\n")
+            self.session._write(NO_ROOM)
         else:
-            self.session.user.room.broadcast_message(message,self.session.user)
-            self.session.user.room.send_message(message,self.session.user)
+            self.session.user.room.post(message,self.session.user)
 
-    def list_rooms(self):
+    def list_rooms(self, rest: bytes = b""):
         """Handles the /list command."""
         if len(self.room_manager.get_rooms()) == 0:
-            self.session.chan.write("There are no rooms available. \r\n")
+            self.session._write(NO_ROOMS)
             return
-        rooms = ", ".join([room.name for room in self.room_manager.get_rooms()])
-        self.session.chan.write(f"Available rooms: {rooms}\r\n")
+        rooms = self.room_manager.get_rooms_str()
+        self.session._write(f"Available rooms: {rooms}\r\n".encode())
 
-    def list_users(self):
+    def list_users(self, rest: bytes = b""):
         """Handles the /users command."""
         if self.session.user.room:
-            users_in_room = ", ".join([u.username for u in self.session.user.room.users])
-            self.session.chan.write(f"Users in {self.session.user.room.name}: {users_in_room}\r\n")
+            users_in_room = ", ".join(self.session.user.room.users.keys())
+            self.session._write(f"Users in {self.session.user.room.name}: {users_in_room}\r\n".encode())
         else:
-            self.session.chan.write(f"You must join a room first.\r\n")
+            self.session._write(NO_ROOM)
             
 class SSHServerSession(asyncssh.SSHServerSession):
     """
@@ -221,15 +321,77 @@ class SSHServerSession(asyncssh.SSHServerSession):
     def connection_made(self, chan):
         """Called when a new connection is made."""
         self.chan = chan
-        self.chan.write('Welcome to the chat server!\r\n')
-    
+        self._write = chan.write  # Bound once; skips two attribute lookups per reply
+        self._line_buf = bytearray()
+        self._echo = False  # Set when a PTY is requested; the binary channel has no line editor
+        # The username is known from authentication by the time the session
+        # channel opens, so attach the User here rather than during auth.
+        if self.username:
+            user = self.user_manager.get_user(self.username)
+            if not user:
+                user = User(self.username, chan)
+                self.user_manager.add_user(user)
+            else:
+                user.channel = chan
+            user._channels.append(chan)
+            self.user = user
+        self._write(WELCOME)
+
+    def shell_requested(self) -> bool:
+        """Accepts interactive shell requests; asyncssh rejects them by default."""
+        return True
+
+    def pty_requested(self, term_type, term_size, term_modes) -> bool:
+        """Accepts the PTY request and enables input echo for interactive clients."""
+        self._echo = True
+        return True
+
+    def connection_lost(self, exc):
+        """Called when the SSH session is dropped; detaches the user from their room."""
+        user = self.user
+        if not user:
+            return
+        if self.chan in user._channels:
+            user._channels.remove(self.chan)
+        if user._channels:
+            # A multiplexed client still has other sessions open for this
+            # user; rebind their active channel to a surviving session so
+            # broadcasts keep flowing, and only the last close detaches them.
+            if user.channel is self.chan:
+                user.channel = user._channels[-1]
+            return
+        room = user.room
+        if room is not None:
+            # Remove directly rather than via leave_room: the channel is gone,
+            # so no confirmation can be written back to this session.
+            room.remove_user(user)
+            room.send_message(f"{user.username} left the room.", user)
+            room.broadcast_bytes(user._leave_notice, user)
+            user.room = None
+        self.user_manager.users.pop(user.username, None)
+
     def data_received(self, data, datatype):
         """Called when data is received from the client."""
-        decoded_data = data.decode().strip()
-        if not self.user:
-            self.chan.write("Please authenticate first. \r\n")
-            return
-        self.command_handler.handle_command(decoded_data)
+        # SSH may deliver input in arbitrary chunks (down to one keystroke),
+        # so buffer until a full line arrives before dispatching. Decoding is
+        # deferred to the handlers that actually need text.
+        # PTY clients send \r on Enter (the binary channel bypasses asyncssh's
+        # line editor), so normalize both \r\n and bare \r to \n. A \r\n split
+        # across chunks yields an empty line, which is skipped below.
+        if self._echo:
+            # No line editor on the binary channel, so echo keystrokes back
+            # ourselves; Enter is echoed as a full \r\n.
+            self._write(data.replace(b"\r\n", b"\r").replace(b"\r", b"\r\n"))
+        self._line_buf += data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        nl = self._line_buf.find(b"\n")
+        while nl != -1:
+            line = bytes(self._line_buf[:nl]).strip()
+            del self._line_buf[:nl + 1]
+            if not self.user:
+                self._write(AUTH_REQUIRED)
+            elif line:
+                self.command_handler.handle_command(line)
+            nl = self._line_buf.find(b"\n")
         
 class SSHServer(asyncssh.SSHServer):
     """
@@ -240,6 +402,7 @@ class SSHServer(asyncssh.SSHServer):
     """
     def connection_made(self, conn):
         """Called when a new connection is made."""
+        self._conn = conn
         print('SSH connection received from %s.' %
               conn.get_extra_info('peername')[0])
 
@@ -254,32 +417,32 @@ class SSHServer(asyncssh.SSHServer):
     
     def validate_public_key(self, public_key, username) -> bool:
         """Validates a user's public key."""
-        session_list = self._sessions.copy()
-        user = self.user_manager.get_user(username)
-        if session_list:
-            #We search the session by username to connect the User to the current session
-            for session in session_list:
-                if session.username == username:
-                    if not user:
-                        session.user = User(username,session.chan)
-                        self.user_manager.add_user(session.user)
-                    else:
-                        session.user = user
-                        session.user.channel = session.chan
+        # Runs during authentication, before any session channel exists, so it
+        # only validates; the User is attached in the session's connection_made.
         return True
-    
+
     def session_requested(self):
         """
         Called when a new session is requested.
 
+        May be called several times on one connection: clients using SSH
+        multiplexing (ControlMaster) open extra sessions over the existing
+        connection, skipping the per-connection key exchange. The most recent
+        session becomes the user's active channel.
+
         Returns:
             SSHServerSession: A new session for the connected user.
         """
-        return SSHServerSession(self,self.user_manager,self.room_manager)
-    
+        session = SSHServerSession(self,self.user_manager,self.room_manager)
+        session.username = self.username
+        # Open the channel in binary mode: the whole pipeline works on
+        # pre-encoded bytes, both for input buffering and broadcast writes.
+        return self._conn.create_server_channel(encoding=None), session
+
     def __init__(self, user_manager:UserManager, room_manager:RoomManager) -> None:
         self.user_manager = user_manager
         self.room_manager = room_manager
+        self.username = None
 
 async def start_ssh_server(user_manager:UserManager, room_manager:RoomManager):
     """
@@ -290,15 +453,26 @@ async def start_ssh_server(user_manager:UserManager, room_manager:RoomManager):
     """
     port = int(os.getenv("SSH_SERVER_PORT", "2223"))
     print(f"Starting ssh server on {port}")
-    await asyncssh.create_server(lambda: SSHServer(user_manager, room_manager), '127.0.0.1', port)
-    
-if __name__ == "__main__":
+    return await asyncssh.create_server(lambda: SSHServer(user_manager, room_manager), '127.0.0.1', port)
+
+async def main():
+    """Starts the SSH server and serves until it is closed."""
     user_manager = UserManager()
     room_manager = RoomManager()
-    loop = asyncio.get_event_loop()
+    server = await start_ssh_server(user_manager, room_manager)
+    # Holding the acceptor open here means shutdown closes the listener and
+    # drains channels instead of discarding the server object.
+    async with server:
+        await server.wait_closed()
+
+if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass  # Fall back to the stock asyncio event loop
     try:
-        loop.run_until_complete(start_ssh_server(user_manager, room_manager))
-        loop.run_forever()
+        asyncio.run(main())
     except (OSError, asyncssh.misc.ChannelOpenError) as e:
       print("Error:", e)
 